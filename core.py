@@ -0,0 +1,195 @@
+"""
+Image Optimizer - core image processing
+Author: Piotr Proszowski
+
+Shared by the GUI and its worker processes; this module must not import Qt.
+"""
+
+import PIL
+from PIL import Image, TiffImagePlugin, features
+import functools
+import io
+import os
+import shutil
+import subprocess
+
+# Pillow-SIMD publishes its releases as post-releases of the matching Pillow version
+PILLOW_SIMD = ".post" in PIL.__version__
+
+# Encode buffer reused across calls; each worker process handles one image
+# at a time, so a single buffer per process is enough
+output_buffer = io.BytesIO()
+
+def clear_output_buffer():
+    """Empty the reusable encode buffer."""
+    output_buffer.seek(0)
+    output_buffer.truncate()
+
+def write_encoded(img, output_path, format, **params):
+    """Encode img into the reusable buffer and write it out in one call."""
+    # Start empty even if an earlier encode failed part-way through
+    clear_output_buffer()
+    try:
+        img.save(output_buffer, format=format, **params)
+        with open(output_path, 'wb', buffering=0) as f, output_buffer.getbuffer() as view:
+            f.write(view)
+    finally:
+        clear_output_buffer()
+
+def warm_up():
+    """Load and initialize the JPEG and WebP codecs in a fresh worker process.
+
+    Runs as the pool initializer, where any exception would break the whole
+    pool, so codecs missing from this Pillow build are simply skipped.
+    """
+    img = Image.new("RGB", (1, 1))
+    for format, feature in (("JPEG", "jpg"), ("WEBP", "webp")):
+        if not features.check(feature):
+            continue
+        try:
+            img.save(output_buffer, format=format)
+        except Exception:
+            pass
+        finally:
+            clear_output_buffer()
+
+def find_cjpeg():
+    """Return the path of an installed cjpeg (e.g. from mozjpeg), or None."""
+    return shutil.which("cjpeg")
+
+def encode_with_cjpeg(img, output_path, quality, cjpeg_path):
+    """Encode img as JPEG by piping it to an external cjpeg as PPM."""
+    args = [cjpeg_path, "-quality", str(quality), "-optimize"]
+    # mozjpeg defaults to progressive, which only pays off on larger images;
+    # small thumbnails encode faster as a single baseline scan
+    args.append("-progressive" if max(img.size) >= 256 else "-baseline")
+    args += ["-outfile", output_path]
+
+    if img.mode not in ("RGB", "L"):
+        img = img.convert("RGB")
+    clear_output_buffer()
+    try:
+        img.save(output_buffer, format="PPM")
+        subprocess.run(args, input=output_buffer.getvalue(), capture_output=True, check=True,
+                       # Keep Windows from flashing a console for every image
+                       creationflags=getattr(subprocess, "CREATE_NO_WINDOW", 0))
+    finally:
+        clear_output_buffer()
+
+def resample_filter(scale):
+    """Pick the cheapest resize filter that still looks right for a downscale ratio."""
+    if scale >= 4:
+        return Image.BOX
+    if scale >= 2:
+        return Image.BILINEAR
+    return Image.LANCZOS
+
+def optimize_image(input_path, output_path, max_width, max_height, quality, convert_to_webp=False,
+                   webp_method=4, cjpeg_path=None, input_data=None):
+    """Optimize the image by resizing and optionally converting to webp format.
+
+    JPEG output is encoded with the cjpeg binary at cjpeg_path when given.
+
+    If input_data holds the already-read file contents, the image is decoded
+    from memory instead of reopening input_path. The output directory must
+    already exist.
+    """
+    try:
+        source = io.BytesIO(input_data) if input_data is not None else input_path
+        with Image.open(source) as img:
+            # Image.open only parses the header, so this check is essentially free
+            if img.width <= max_width and img.height <= max_height and not convert_to_webp:
+                # Already small enough and no format change: keep the original bytes
+                if input_data is not None:
+                    with open(output_path, 'wb') as f:
+                        f.write(input_data)
+                else:
+                    shutil.copyfile(input_path, output_path)
+                return True
+
+            # thumbnail() already box-reduces to within reducing_gap (2x) of the
+            # target before filtering, and skips that step for P and 1 images
+            scale = max(img.width / max_width, img.height / max_height)
+            img.thumbnail((max_width, max_height), resample_filter(scale))
+            
+            # Split the output name once for both the WebP rename and the format lookup
+            stem, ext = os.path.splitext(output_path)
+            ext = ext.lower()
+            if convert_to_webp:
+                ext = ".webp"
+                output_path = stem + ext
+
+            if ext == ".webp":
+                # method trades encode speed (0) against compression effort (6)
+                write_encoded(img, output_path, "WEBP", quality=quality, method=webp_method)
+            elif ext in (".jpg", ".jpeg") and cjpeg_path:
+                encode_with_cjpeg(img, output_path, quality, cjpeg_path)
+            else:
+                write_encoded(img, output_path, Image.registered_extensions()[ext],
+                              optimize=True, quality=quality)
+        return True
+    except subprocess.CalledProcessError as e:
+        # cjpeg explains its failures on stderr; the exit status alone says nothing
+        return e.stderr.decode(errors="replace").strip() or str(e)
+    except Exception as e:
+        return str(e)
+
+def make_optimizer(max_width, max_height, quality, convert_to_webp=False, webp_method=4,
+                   cjpeg_path=None):
+    """Bind the settings shared by a whole batch to optimize_image.
+
+    The result is called as optimizer(input_path, output_path, input_data=None).
+    It is a functools.partial rather than a closure so it can be sent to
+    worker processes.
+    """
+    return functools.partial(optimize_image, max_width=max_width, max_height=max_height,
+                             quality=quality, convert_to_webp=convert_to_webp,
+                             webp_method=webp_method, cjpeg_path=cjpeg_path)
+
+# Leading signature bytes of the supported formats
+IMAGE_MAGIC = (
+    (b'\xff\xd8\xff', 'jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'GIF8', 'gif'),
+    (b'BM', 'bmp'),
+    # Every byte order and BigTIFF variant Pillow's TIFF plugin accepts
+    *((prefix, 'tiff') for prefix in TiffImagePlugin.PREFIXES),
+)
+
+def sniff_image_format(data):
+    """Identify an image format from its first bytes, or return None."""
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'webp'
+    for magic, fmt in IMAGE_MAGIC:
+        if data.startswith(magic):
+            return fmt
+    return None
+
+def is_up_to_date(input_path, output_path):
+    """Check whether output_path exists and is at least as new as input_path."""
+    try:
+        return os.stat(output_path).st_mtime >= os.stat(input_path).st_mtime
+    except OSError:
+        return False
+
+def read_image_bytes(path):
+    """Read the raw contents of an image file.
+
+    Raises ValueError if the contents do not start with a known image
+    signature, so misnamed or broken files never reach a decoder.
+    """
+    # The whole file is read in one call, so an extra buffering layer only adds a copy
+    with open(path, 'rb', buffering=0) as f:
+        if hasattr(os, "posix_fadvise"):
+            # Let the kernel read ahead aggressively on slow disks
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        data = f.read()
+    if sniff_image_format(data) is None:
+        raise ValueError("not a supported image file")
+    return data
+
+IMAGE_EXTS = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tiff', '.webp')
+
+def is_image_file(filename):
+    """Check if a file is an image based on its extension."""
+    return filename.lower().endswith(IMAGE_EXTS)
@@ -3,35 +3,156 @@ Image Optimizer
 Author: Piotr Proszowski
 """
 
-from PIL import Image, UnidentifiedImageError
+import PIL
+from PIL import features
+import json
+import logging
 import os
 import sys
+import time
+import multiprocessing
+from concurrent.futures import (ProcessPoolExecutor, ThreadPoolExecutor, wait,
+                                FIRST_COMPLETED, CancelledError)
+from concurrent.futures.process import BrokenProcessPool
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, 
                             QHBoxLayout, QPushButton, QLabel, QLineEdit, 
                             QProgressBar, QCheckBox, QFileDialog, QMessageBox,
                             QComboBox)
-from PyQt5.QtCore import Qt, QMimeData
+from PyQt5.QtCore import Qt, QMimeData, QObject, QThread, pyqtSignal
 from PyQt5.QtGui import QDragEnterEvent, QDropEvent
 
-def optimize_image(input_path, output_path, max_width, max_height, quality, convert_to_webp=False):
-    """Optimize the image by resizing and optionally converting to webp format."""
+from core import (PILLOW_SIMD, make_optimizer, read_image_bytes, is_image_file,
+                  is_up_to_date, find_cjpeg, warm_up)
+
+logger = logging.getLogger(__name__)
+
+# Subfolder of the selected directory that receives the optimized images
+OUTPUT_FOLDER = "optimized"
+
+# File in OUTPUT_FOLDER mapping each output (relative to the folder) to the
+# settings it was produced with
+SETTINGS_STAMP = ".settings.json"
+
+def read_settings_stamp(output_root):
+    """Return the per-output settings recorded in output_root ({} if none)."""
     try:
-        os.makedirs(os.path.dirname(output_path), exist_ok=True)
-        with Image.open(input_path) as img:
-            img.thumbnail((max_width, max_height))
-            
-            if convert_to_webp:
-                output_path = os.path.splitext(output_path)[0] + ".webp"
-            
-            img.save(output_path, optimize=True, quality=quality)
-        return True
-    except Exception as e:
-        return str(e)
+        with open(os.path.join(output_root, SETTINGS_STAMP)) as f:
+            stamp = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return stamp if isinstance(stamp, dict) else {}
 
-def is_image_file(filename):
-    """Check if a file is an image based on its extension."""
-    image_extensions = {'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tiff', '.webp'}
-    return os.path.splitext(filename)[1].lower() in image_extensions
+def write_settings_stamp(output_root, stamp):
+    """Record the per-output settings for output_root."""
+    with open(os.path.join(output_root, SETTINGS_STAMP), 'w') as f:
+        json.dump(stamp, f)
+
+# Application-wide stylesheets, applied once in main() for the detected theme
+DARK_STYLESHEET = """
+    QMainWindow {
+        background-color: #1e1e1e;
+    }
+    QPushButton {
+        background-color: #4CAF50;
+        color: white;
+        padding: 8px 15px;
+        border-radius: 4px;
+        min-width: 80px;
+        border: none;
+    }
+    QPushButton:hover {
+        background-color: #45a049;
+    }
+    QLineEdit {
+        padding: 8px;
+        border: 1px solid #333;
+        border-radius: 4px;
+        background-color: #2d2d2d;
+        color: #ffffff;
+    }
+    QLineEdit:focus {
+        border: 1px solid #4CAF50;
+        background-color: #363636;
+    }
+    QProgressBar {
+        border: 1px solid #333;
+        border-radius: 4px;
+        text-align: center;
+        background-color: #2d2d2d;
+        color: #ffffff;
+    }
+    QProgressBar::chunk {
+        background-color: #4CAF50;
+        border-radius: 3px;
+    }
+    QLabel {
+        color: #ffffff;
+    }
+    QCheckBox {
+        color: #ffffff;
+    }
+    QCheckBox::indicator {
+        width: 18px;
+        height: 18px;
+        background-color: #2d2d2d;
+        border: 1px solid #333;
+    }
+    QCheckBox::indicator:checked {
+        background-color: #4CAF50;
+        border-radius: 2px;
+    }
+"""
+
+LIGHT_STYLESHEET = """
+    QMainWindow {
+        background-color: #ffffff;
+    }
+    QPushButton {
+        background-color: #4CAF50;
+        color: white;
+        padding: 8px 15px;
+        border-radius: 4px;
+        min-width: 80px;
+        border: none;
+    }
+    QPushButton:hover {
+        background-color: #45a049;
+    }
+    QLineEdit {
+        padding: 8px;
+        border: 1px solid #ddd;
+        border-radius: 4px;
+        background-color: #fafafa;
+    }
+    QLineEdit:focus {
+        border: 1px solid #4CAF50;
+        background-color: white;
+    }
+    QProgressBar {
+        border: 1px solid #ddd;
+        border-radius: 4px;
+        text-align: center;
+        background-color: #fafafa;
+    }
+    QProgressBar::chunk {
+        background-color: #4CAF50;
+        border-radius: 3px;
+    }
+    QLabel {
+        color: #333333;
+    }
+    QCheckBox {
+        color: #333333;
+    }
+    QCheckBox::indicator {
+        width: 18px;
+        height: 18px;
+    }
+    QCheckBox::indicator:checked {
+        background-color: #4CAF50;
+        border-radius: 2px;
+    }
+"""
 
 class DragDropLineEdit(QLineEdit):
     """Custom QLineEdit that accepts drag and drop of folders."""
@@ -59,6 +180,118 @@ class DragDropLineEdit(QLineEdit):
                 event.acceptProposedAction()
                 return
 
+class OptimizeWorker(QObject):
+    """Runs a batch of image optimizations off the GUI thread."""
+
+    # Minimum time between progress updates, in seconds
+    PROGRESS_INTERVAL = 0.05
+
+    progress = pyqtSignal(int)
+    error = pyqtSignal(str)
+    finished = pyqtSignal(int, int, int)
+
+    def __init__(self, executor, optimizer, tasks):
+        super().__init__()
+        self.executor = executor
+        self.optimizer = optimizer
+        self.tasks = tasks
+        # Output paths that hold a result of this batch's settings once run() ends
+        self.succeeded = []
+        self.pool_broken = False
+        self.cancelled = False
+
+    def cancel(self):
+        """Ask run() to stop after the file it is currently waiting on."""
+        self.cancelled = True
+
+    def read_task(self, input_path, output_path, may_skip):
+        """Read an input file, or return None if its output is already up to date.
+
+        may_skip says whether the existing output was made with the current
+        settings; only then is its timestamp trusted.
+        """
+        if may_skip and is_up_to_date(input_path, output_path):
+            return None
+        return read_image_bytes(input_path)
+
+    def run(self):
+        """Drive the process pool and report each completed file."""
+        total = len(self.tasks)
+        processed = 0
+        errors = 0
+        skipped = 0
+        # Cap how many files are held in memory (being read or processed) at once
+        max_in_flight = 2 * max(1, min(os.cpu_count() or 1, total))
+        pending = iter(self.tasks)
+        reads = {}
+        futures = {}
+        # Throttle progress signals so large batches of small images do not
+        # flood the GUI thread with repaints
+        tick = max(1, total // 100)
+        last_progress = time.monotonic()
+
+        try:
+            # Reader threads prefetch file bytes so disk I/O overlaps with the
+            # CPU-bound decode/resize/encode running in the process pool
+            with ThreadPoolExecutor(max_workers=2) as readers:
+                while not self.cancelled:
+                    while len(reads) + len(futures) < max_in_flight:
+                        task = next(pending, None)
+                        if task is None:
+                            break
+                        reads[readers.submit(self.read_task, *task[1:])] = task
+
+                    if not reads and not futures:
+                        break
+
+                    done, _ = wait(list(reads) + list(futures), return_when=FIRST_COMPLETED)
+                    for future in done:
+                        if future in reads:
+                            rel_path, input_path, output_path, _ = reads.pop(future)
+                            try:
+                                data = future.result()
+                            except (OSError, ValueError) as e:
+                                result = str(e)
+                            else:
+                                if data is None:
+                                    skipped += 1
+                                    result = True
+                                else:
+                                    futures[self.executor.submit(
+                                        self.optimizer, input_path, output_path,
+                                        input_data=data)] = (rel_path, output_path)
+                                    continue
+                        else:
+                            rel_path, output_path = futures.pop(future)
+                            result = future.result()
+
+                        if result is True:
+                            self.succeeded.append(output_path)
+                        else:
+                            self.error.emit(f"{rel_path}: {result}")
+                            errors += 1
+
+                        processed += 1
+                        now = time.monotonic()
+                        if (processed % tick == 0 or processed == total
+                                or now - last_progress >= self.PROGRESS_INTERVAL):
+                            self.progress.emit(processed)
+                            last_progress = now
+        except (BrokenProcessPool, RuntimeError, CancelledError) as e:
+            # A crashed pool raises BrokenProcessPool; a pool shut down under us
+            # raises RuntimeError on submit and CancelledError for queued work
+            self.pool_broken = True
+            if not self.cancelled:
+                self.error.emit(f"Image processing stopped unexpectedly: {str(e)}")
+            errors += total - processed
+            processed = total
+
+        if self.cancelled:
+            # The window is closing; nobody is left to report the results to
+            return
+
+        self.finished.emit(processed, errors, skipped)
+
 class ImageOptimizerWindow(QMainWindow):
     def __init__(self):
         super().__init__()
@@ -70,118 +303,6 @@ class ImageOptimizerWindow(QMainWindow):
         self.author_label.setAlignment(Qt.AlignRight)
         self.author_label.setStyleSheet("color: #666666; padding: 5px;")
         
-        # Detect system theme
-        app = QApplication.instance()
-        self.is_dark_mode = app.palette().window().color().lightness() < 128
-        
-        # Set theme-dependent styles
-        if self.is_dark_mode:
-            self.setStyleSheet("""
-                QMainWindow {
-                    background-color: #1e1e1e;
-                }
-                QPushButton {
-                    background-color: #4CAF50;
-                    color: white;
-                    padding: 8px 15px;
-                    border-radius: 4px;
-                    min-width: 80px;
-                    border: none;
-                }
-                QPushButton:hover {
-                    background-color: #45a049;
-                }
-                QLineEdit {
-                    padding: 8px;
-                    border: 1px solid #333;
-                    border-radius: 4px;
-                    background-color: #2d2d2d;
-                    color: #ffffff;
-                }
-                QLineEdit:focus {
-                    border: 1px solid #4CAF50;
-                    background-color: #363636;
-                }
-                QProgressBar {
-                    border: 1px solid #333;
-                    border-radius: 4px;
-                    text-align: center;
-                    background-color: #2d2d2d;
-                    color: #ffffff;
-                }
-                QProgressBar::chunk {
-                    background-color: #4CAF50;
-                    border-radius: 3px;
-                }
-                QLabel {
-                    color: #ffffff;
-                }
-                QCheckBox {
-                    color: #ffffff;
-                }
-                QCheckBox::indicator {
-                    width: 18px;
-                    height: 18px;
-                    background-color: #2d2d2d;
-                    border: 1px solid #333;
-                }
-                QCheckBox::indicator:checked {
-                    background-color: #4CAF50;
-                    border-radius: 2px;
-                }
-            """)
-        else:
-            self.setStyleSheet("""
-                QMainWindow {
-                    background-color: #ffffff;
-                }
-                QPushButton {
-                    background-color: #4CAF50;
-                    color: white;
-                    padding: 8px 15px;
-                    border-radius: 4px;
-                    min-width: 80px;
-                    border: none;
-                }
-                QPushButton:hover {
-                    background-color: #45a049;
-                }
-                QLineEdit {
-                    padding: 8px;
-                    border: 1px solid #ddd;
-                    border-radius: 4px;
-                    background-color: #fafafa;
-                }
-                QLineEdit:focus {
-                    border: 1px solid #4CAF50;
-                    background-color: white;
-                }
-                QProgressBar {
-                    border: 1px solid #ddd;
-                    border-radius: 4px;
-                    text-align: center;
-                    background-color: #fafafa;
-                }
-                QProgressBar::chunk {
-                    background-color: #4CAF50;
-                    border-radius: 3px;
-                }
-                QLabel {
-                    color: #333333;
-                }
-                QCheckBox {
-                    color: #333333;
-                }
-                QCheckBox::indicator {
-                    width: 18px;
-                    height: 18px;
-                }
-                QCheckBox::indicator:checked {
-                    background-color: #4CAF50;
-                    border-radius: 2px;
-                }
-            """)
-
         # Create main widget and layout
         main_widget = QWidget()
         self.setCentralWidget(main_widget)
@@ -235,6 +356,7 @@ class ImageOptimizerWindow(QMainWindow):
 
         # Settings
         self.quality_input = QLineEdit("85")
+        self.webp_method_input = QLineEdit("4")
         self.webp_checkbox = QCheckBox("Convert to WebP")
         self.webp_checkbox.setChecked(True)
         
@@ -242,11 +364,26 @@ class ImageOptimizerWindow(QMainWindow):
         self.recursive_checkbox = QCheckBox("Process subfolders recursively")
         self.recursive_checkbox.setChecked(True)
 
+        # Add option to skip files whose output is newer than the source
+        self.skip_existing_checkbox = QCheckBox("Skip images already optimized")
+        self.skip_existing_checkbox.setChecked(True)
+
+        # Add optional mozjpeg encoder, only usable when cjpeg is installed
+        self.cjpeg_path = find_cjpeg()
+        self.mozjpeg_checkbox = QCheckBox("Encode JPEG with mozjpeg (cjpeg)")
+        if self.cjpeg_path is None:
+            self.mozjpeg_checkbox.setEnabled(False)
+            self.mozjpeg_checkbox.setToolTip("cjpeg was not found on PATH")
+
         # Add settings to layout
         layout.addWidget(QLabel("Quality (1-100):"))
         layout.addWidget(self.quality_input)
         layout.addWidget(self.webp_checkbox)
+        layout.addWidget(QLabel("WebP method (0-6, lower is faster):"))
+        layout.addWidget(self.webp_method_input)
         layout.addWidget(self.recursive_checkbox)
+        layout.addWidget(self.skip_existing_checkbox)
+        layout.addWidget(self.mozjpeg_checkbox)
 
         # Progress bar
         self.progress_bar = QProgressBar()
@@ -255,9 +392,23 @@ class ImageOptimizerWindow(QMainWindow):
         layout.addWidget(self.status_label)
 
         # Start button
-        start_button = QPushButton("Start Optimization")
-        start_button.clicked.connect(self.start_optimization)
-        layout.addWidget(start_button)
+        self.start_button = QPushButton("Start Optimization")
+        self.start_button.clicked.connect(self.start_optimization)
+        layout.addWidget(self.start_button)
+
+        # Output folder, settings and per-output stamp of the running batch
+        self.batch_output_root = None
+        self.batch_settings = None
+        self.batch_stamp = None
+
+        # Background worker state; the process pool is kept across batches
+        # so worker processes only pay for imports and codec setup once
+        self.executor = None
+        self.executor_workers = 0
+        self.worker_thread = None
+        self.worker = None
+        self.total_images = 0
+        self.error_messages = []
 
         # Add author label at the bottom
         layout.addWidget(self.author_label)
@@ -267,6 +418,16 @@ class ImageOptimizerWindow(QMainWindow):
         if folder:
             self.folder_input.setText(folder)
 
+    def closeEvent(self, event):
+        if self.worker_thread is not None and self.worker_thread.isRunning():
+            # Stop the batch and let the worker thread finish before the pool goes away
+            self.worker.cancel()
+            self.worker_thread.quit()
+            self.worker_thread.wait()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+        super().closeEvent(event)
+
     def show_error(self, message):
         QMessageBox.critical(self, "Error", message)
 
@@ -286,22 +447,30 @@ class ImageOptimizerWindow(QMainWindow):
         """Get all image files in the directory, optionally recursively."""
         image_files = []
         
-        if recursive:
-            # Walk through all directories and subdirectories
-            for root, _, files in os.walk(directory):
-                for filename in files:
-                    if is_image_file(filename):
+        # Walk with scandir directly: each entry already carries its full path
+        # and file type, so no extra join, relpath or stat is needed per file
+        prefix_len = len(os.path.join(directory, ""))
+        # Never pick up our own output from a previous run
+        output_root = os.path.join(directory, OUTPUT_FOLDER)
+        pending = [directory]
+        while pending:
+            current = pending.pop()
+            try:
+                entries = os.scandir(current)
+            except OSError:
+                # Skip unreadable subfolders, as os.walk did
+                if current == directory:
+                    raise
+                continue
+            with entries:
+                for entry in entries:
+                    if recursive and entry.is_dir(follow_symlinks=False):
+                        if entry.path != output_root:
+                            pending.append(entry.path)
+                    elif is_image_file(entry.name) and entry.is_file():
                         # Store the full path and relative path for processing
-                        full_path = os.path.join(root, filename)
-                        rel_path = os.path.relpath(full_path, directory)
-                        image_files.append((full_path, rel_path))
-        else:
-            # Just process the files in the top directory
-            for filename in os.listdir(directory):
-                full_path = os.path.join(directory, filename)
-                if os.path.isfile(full_path) and is_image_file(filename):
-                    image_files.append((full_path, filename))
-                    
+                        image_files.append((entry.path, entry.path[prefix_len:]))
+
         return image_files
 
     def start_optimization(self):
@@ -314,10 +483,13 @@ class ImageOptimizerWindow(QMainWindow):
             max_width = int(self.width_input.text() or 800)
             max_height = int(self.height_input.text() or 800)
             quality = int(self.quality_input.text() or 85)
+            webp_method = int(self.webp_method_input.text() or 4)
             recursive = self.recursive_checkbox.isChecked()
             
             if max_width <= 0 or max_height <= 0:
                 raise ValueError("Dimensions must be positive numbers")
+            if not 0 <= webp_method <= 6:
+                raise ValueError("WebP method must be between 0 and 6")
                 
         except ValueError as e:
             self.show_error(f"Invalid input: {str(e)}")
@@ -332,35 +504,147 @@ class ImageOptimizerWindow(QMainWindow):
             self.show_info("No images found in selected directory")
             return
 
-        processed = 0
-        errors = 0
+        self.total_images = total_images
+        self.error_messages = []
         self.progress_bar.setMaximum(total_images)
         self.progress_bar.setValue(0)
 
+        convert_to_webp = self.webp_checkbox.isChecked()
+        cjpeg_path = self.cjpeg_path if self.mozjpeg_checkbox.isChecked() else None
+
+        # Settings are the same for every file, so bind them once for the batch
+        optimizer = make_optimizer(max_width, max_height, quality, convert_to_webp,
+                                   webp_method, cjpeg_path)
+
+        # An existing output only counts as up to date if the stamp says it was
+        # produced with exactly these settings; otherwise it is always redone
+        output_root = os.path.join(directory, OUTPUT_FOLDER)
+        settings = {
+            "max_width": max_width,
+            "max_height": max_height,
+            "quality": quality,
+            "convert_to_webp": convert_to_webp,
+            "webp_method": webp_method,
+            "mozjpeg": cjpeg_path is not None,
+        }
+        stamp = read_settings_stamp(output_root)
+        skip_existing = self.skip_existing_checkbox.isChecked()
+        stamp_changed = False
+
+        # Build the task list up front so every worker gets plain, picklable arguments
+        tasks = []
+        output_dirs = set()
         for input_path, rel_path in image_files:
             # Create output path preserving directory structure
-            output_path = os.path.join(directory, "optimized", rel_path)
-            
-            result = optimize_image(input_path, output_path, max_width, max_height, 
-                                  quality, self.webp_checkbox.isChecked())
-            
-            if result is not True:
-                self.show_error(f"Error processing {rel_path}: {result}")
-                errors += 1
-            
-            processed += 1
-            self.progress_bar.setValue(processed)
-            self.status_label.setText(f"Processing: {processed}/{total_images}")
-            QApplication.processEvents()
+            output_path = os.path.join(output_root, rel_path)
+            if convert_to_webp:
+                # Name the final output up front so it can be checked for staleness
+                output_path = os.path.splitext(output_path)[0] + ".webp"
+            output_dirs.add(os.path.dirname(output_path))
+
+            key = os.path.relpath(output_path, output_root)
+            may_skip = skip_existing and stamp.get(key) == settings
+            if not may_skip and key in stamp:
+                # This output is about to be rewritten; until the batch confirms
+                # it, nothing should vouch for it
+                del stamp[key]
+                stamp_changed = True
+            tasks.append((rel_path, input_path, output_path, may_skip))
+
+        # Create each output directory once rather than once per file
+        try:
+            for output_dir in output_dirs:
+                os.makedirs(output_dir, exist_ok=True)
+        except OSError as e:
+            self.show_error(f"Cannot create output folder: {str(e)}")
+            return
+
+        if stamp_changed:
+            try:
+                write_settings_stamp(output_root, stamp)
+            except OSError as e:
+                logger.warning("Could not record output settings: %s", e)
+        self.batch_output_root = output_root
+        self.batch_settings = settings
+        self.batch_stamp = stamp
+
+        # Run the batch in a worker thread so the event loop stays responsive
+        self.worker_thread = QThread()
+        # No point starting more worker processes than there are files; replace
+        # the pool when the batch calls for a different size
+        workers = max(1, min(os.cpu_count() or 1, total_images))
+        if self.executor is not None and self.executor_workers != workers:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=workers, initializer=warm_up)
+            self.executor_workers = workers
+        self.worker = OptimizeWorker(self.executor, optimizer, tasks)
+        self.worker.moveToThread(self.worker_thread)
+        self.worker_thread.started.connect(self.worker.run)
+        self.worker.progress.connect(self.on_progress)
+        self.worker.error.connect(self.on_error)
+        self.worker.finished.connect(self.on_optimization_finished)
+        self.worker.finished.connect(self.worker_thread.quit)
+
+        self.start_button.setEnabled(False)
+        self.status_label.setText(f"Processing: 0/{total_images}")
+        self.worker_thread.start()
 
-        success_count = processed - errors
+    def on_progress(self, processed):
+        self.progress_bar.setValue(processed)
+        self.status_label.setText(f"Processing: {processed}/{self.total_images}")
+
+    def on_error(self, message):
+        self.error_messages.append(message)
+
+    def on_optimization_finished(self, processed, errors, skipped):
+        if self.worker.pool_broken:
+            # A crashed pool cannot take new work; start a fresh one next time
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+        # Vouch only for the outputs this batch actually produced or confirmed;
+        # failed files stay unstamped and are redone next time
+        for output_path in self.worker.succeeded:
+            key = os.path.relpath(output_path, self.batch_output_root)
+            self.batch_stamp[key] = self.batch_settings
+        try:
+            write_settings_stamp(self.batch_output_root, self.batch_stamp)
+        except OSError as e:
+            logger.warning("Could not record output settings: %s", e)
+
+        if self.error_messages:
+            # Report all failures in one dialog instead of one modal per file
+            shown = self.error_messages[:10]
+            message = "Errors while processing:\n" + "\n".join(shown)
+            if len(self.error_messages) > len(shown):
+                message += f"\n...and {len(self.error_messages) - len(shown)} more"
+            self.show_error(message)
+
+        success_count = processed - errors - skipped
         self.show_info(f"Optimized {success_count} images successfully" + 
+                      (f", {skipped} already up to date" if skipped > 0 else "") +
                       (f", {errors} errors" if errors > 0 else ""))
         self.status_label.setText("Ready")
         self.progress_bar.setValue(0)
+        self.start_button.setEnabled(True)
 
 def main():
+    # Required for the process pool in PyInstaller-frozen builds
+    multiprocessing.freeze_support()
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
+    logger.info("Using Pillow %s%s", PIL.__version__,
+                " (SIMD build)" if PILLOW_SIMD else "")
+    if not features.check_feature("libjpeg_turbo"):
+        logger.warning("Pillow is not linked against libjpeg-turbo; JPEG decoding and "
+                       "encoding will be slower (see README for how to rebuild it)")
     app = QApplication(sys.argv)
+
+    # Detect system theme and style the whole application once
+    is_dark_mode = app.palette().window().color().lightness() < 128
+    app.setStyleSheet(DARK_STYLESHEET if is_dark_mode else LIGHT_STYLESHEET)
+
     window = ImageOptimizerWindow()
     window.show()
     sys.exit(app.exec_())